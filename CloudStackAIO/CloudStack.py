@@ -1,14 +1,47 @@
+from collections import Counter
+from functools import lru_cache
 from functools import partial
 from urllib.parse import quote
-from urllib.parse import urlencode
-from typing import Callable, Optional
+from urllib.parse import urlsplit
+from typing import Callable, Optional, Tuple
+from yarl import URL
 
 import asyncio
 import aiohttp
 import hashlib
-import hmac
+import math
+import re
 import base64
 import logging
+import sys
+import warnings
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+HMAC_SHA1_BLOCK_SIZE = 64
+SIGNATURE_CACHE_SIZE = 256
+JSON_CONTENT_TYPE = re.compile(r"application/(?:[\w.+-]+?\+)?json", re.IGNORECASE)
+URL_SAFE_STRING = re.compile(r"[A-Za-z0-9_.*-]*")
+# public instance attributes of the CloudStack client, which must never be
+# mistaken for CloudStack API calls (e.g. while they are not assigned yet)
+CLIENT_ATTRIBUTES = frozenset(
+    (
+        "end_point",
+        "api_key",
+        "async_poll_latency",
+        "max_page_size",
+        "max_async_poll_latency",
+    )
+)
+# closed SSL transports only leak on Python versions without the fix of
+# https://github.com/python/cpython/pull/118960, newer aiohttp versions warn
+# about enable_cleanup_closed on all other versions
+ENABLE_CLEANUP_CLOSED = not (
+    (3, 12, 8) <= sys.version_info < (3, 13) or sys.version_info >= (3, 13, 1)
+)
 
 
 class CloudStackClientException(Exception):
@@ -49,6 +82,20 @@ class CloudStackClientException(Exception):
 
 
 class CloudStack(object):
+    # client sessions are shared between all clients using the same event loop,
+    # API host and api key to reuse the connection pool of the session
+    _client_sessions = {}
+    _client_session_references = Counter()
+
+    __slots__ = tuple(sorted(CLIENT_ATTRIBUTES)) + (
+        "_api_calls",
+        "_api_secret",
+        "_cached_signature",
+        "_client_session",
+        "_event_loop",
+        "__weakref__",
+    )
+
     def __init__(
         self,
         end_point: str,
@@ -57,6 +104,7 @@ class CloudStack(object):
         event_loop: Optional[asyncio.AbstractEventLoop] = None,
         async_poll_latency: int = 2,
         max_page_size: int = 500,
+        max_async_poll_latency: int = 30,
     ) -> None:
         """
         Client object to access a CloudStack API
@@ -68,10 +116,13 @@ class CloudStack(object):
         :type api_key: str
         :param api_secret: Secret to access the CloudStack API (usually available
             from your cloud provider)
-        :param event_loop: asyncio event loop to utilize
+        :param event_loop: asyncio event loop to utilize, any asyncio compatible
+            event loop like the faster uvloop (``pip install CloudStackAIO[uvloop]``)
+            is supported
         :type event_loop: Optional[asyncio.AbstractEventLoop]
         :param async_poll_latency: Time in seconds to wait before polling
-            CloudStack API to fetch results of asynchronous API calls
+            CloudStack API to fetch results of asynchronous API calls, the time is
+            doubled after each poll of a pending asynchronous API call
         :type async_poll_latency: int
         :param max_page_size: Some API calls are paginated like listVirtualMachines,
             this number specifies the maximum
@@ -79,67 +130,159 @@ class CloudStack(object):
             takes care of the pagination by splitting it into separate API calls
              and returns the entire list
         :type max_page_size: int
+        :param max_async_poll_latency: Maximum time in seconds to wait between two
+            polls of the CloudStack API to fetch results of asynchronous API calls
+        :type max_async_poll_latency: int
 
         :Example:
 
         .. code-block:: python
 
-           event_loop = asyncio.get_event_loop()
-           cloud_stack_client = CloudStack(end_point='https://api.exoscale.ch/compute',
-                                           api_key='<Your API key>',
-                                           api_secret='Your API secret',
-                                           event_loop=event_loop)
+           async with CloudStack(end_point='https://api.exoscale.ch/compute',
+                                 api_key='<Your API key>',
+                                 api_secret='Your API secret') as cloud_stack_client:
+               await cloud_stack_client.listVirtualMachines()
         """
+        self._api_calls = {}
+        self._client_session = None
         self.end_point = end_point
         self.api_key = api_key
         self.api_secret = api_secret
         self._event_loop = event_loop
         self.async_poll_latency = async_poll_latency
         self.max_page_size = max_page_size
-        self._client_session = None
+        self.max_async_poll_latency = max_async_poll_latency
 
     def __del__(self) -> None:
         """
-        Deletion function taking care that the used sessions is closed before the
-        deleting the object. This is mandatory according to the aiohttp documentation.
-        The deletion function is thus scheduling a task that takes care of closing
-        the session. Depending wether an event loop is already running, the task
-        is either scheduled or a new event loop is started.
+        Deletion function warning about a client session that has not been closed
+        before deleting the object. Closing all sessions is mandatory according
+        to the aiohttp documentation. Either use the client as async context
+        manager or call :py:meth:`close` explicitly. The reference to a shared
+        client session is released anyway, so that the remaining clients can
+        still close it.
         """
-        try:
-            self.event_loop.run_until_complete(self._close_session())
-        except RuntimeError:
-            self.event_loop.create_task(self._close_session())
+        if self._client_session and not self._client_session.closed:
+            warnings.warn(
+                "Unclosed CloudStack client {!r}, use 'async with' or "
+                "'await close()'".format(self),
+                ResourceWarning,
+                stacklevel=2,
+            )
+        self._release_client_session()
+
+    async def __aenter__(self) -> "CloudStack":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.close()
 
-    async def _close_session(self) -> None:
+    async def close(self) -> None:
         """
         According to the aiohttp documentation all opened sessions need to be closed,
         before leaving the program. This function takes care that the client session
-        is closed. This async co-routine is automatically scheduled, when the client
-        object is destroyed.
+        is closed. This async co-routine is automatically called, when leaving the
+        async context manager of the client. A new session is opened, if the
+        client is used again afterwards. Since client sessions are shared, the
+        session is only closed once it is not used by any other client anymore.
         """
-        await self.client_session.close()
-        await asyncio.sleep(
-            0.25
-        )  # http://aiohttp.readthedocs.io/en/stable/client_advanced.html#graceful-shutdown # noqa E501
+        client_session = self._release_client_session()
+        if client_session:
+            await client_session.close()
+            await asyncio.sleep(
+                0
+            )  # http://aiohttp.readthedocs.io/en/stable/client_advanced.html#graceful-shutdown # noqa E501
+
+    def _release_client_session(self) -> Optional[aiohttp.ClientSession]:
+        """
+        Releases the reference of this client to its shared client session.
+
+        :return: The client session, if it is not used by any other client
+            anymore and has to be closed, otherwise None
+        :rtype: Optional[aiohttp.ClientSession]
+        """
+        client_session, self._client_session = self._client_session, None
+        if not client_session:
+            return None
+        self._client_session_references[client_session] -= 1
+        if self._client_session_references[client_session] > 0:
+            return None
+        del self._client_session_references[client_session]
+        for key, value in list(self._client_sessions.items()):
+            if value is client_session:
+                del self._client_sessions[key]
+        return client_session
 
     def __getattr__(self, command: str) -> Callable:
         """
         This allows to support any available and future CloudStack API in this client.
         The returned partial function can directly be used to call the corresponding
-        CloudStack API including all supported parameters.
+        CloudStack API including all supported parameters. The partial function is
+        created once per command and client, subsequent look ups are answered from
+        the _api_calls cache. CloudStack API names never start with an underscore,
+        so private and special attributes (e.g. ``__dict__`` probed by introspection
+        tools) raise an AttributeError instead.
 
         :param command: Command string indicating the CloudStack API to be called.
         :type command: str
         :return: Partial function that can be used the call the CloudStack API
             specified in the command string.
         """
-        return partial(self.request, command=command)
+        if command.startswith("_") or command in CLIENT_ATTRIBUTES:
+            raise AttributeError(
+                "{!r} object has no attribute {!r}".format(type(self).__name__, command)
+            )
+        try:
+            return self._api_calls[command]
+        except KeyError:
+            api_call = self._api_calls[command] = partial(self.request, command=command)
+            return api_call
+
+    @property
+    def api_secret(self) -> str:
+        return self._api_secret
+
+    @api_secret.setter
+    def api_secret(self, api_secret: str) -> None:
+        # The HMAC key schedule only depends on the api secret, so the inner and
+        # outer padded keys (RFC 2104) are computed and hashed once here. The
+        # resulting SHA-1 states are copied for each signature.
+        self._api_secret = api_secret
+        key = api_secret.encode("utf-8")
+        if len(key) > HMAC_SHA1_BLOCK_SIZE:
+            key = hashlib.sha1(key).digest()
+        key = key.ljust(HMAC_SHA1_BLOCK_SIZE, b"\0")
+        inner_hash = hashlib.sha1(bytes(byte ^ 0x36 for byte in key))
+        outer_hash = hashlib.sha1(bytes(byte ^ 0x5C for byte in key))
+        # Identical requests (e.g. polling the same list API) have identical
+        # signatures, therefore the most recently used signatures are cached.
+        self._cached_signature = lru_cache(maxsize=SIGNATURE_CACHE_SIZE)(
+            partial(self._signature, inner_hash, outer_hash)
+        )
 
     @property
-    def client_session(self):
+    def client_session(self) -> aiohttp.ClientSession:
         if not self._client_session:
-            self._client_session = aiohttp.ClientSession(loop=self.event_loop)
+            key = (self.event_loop, urlsplit(self.end_point).netloc, self.api_key)
+            client_session = self._client_sessions.get(key)
+            if not client_session or client_session.closed:
+                # the references to a session closed elsewhere are meaningless
+                self._client_session_references.pop(client_session, None)
+                client_session = aiohttp.ClientSession(
+                    loop=self.event_loop,
+                    connector=aiohttp.TCPConnector(
+                        limit=100,
+                        limit_per_host=32,
+                        use_dns_cache=True,
+                        ttl_dns_cache=3600,
+                        keepalive_timeout=75,
+                        enable_cleanup_closed=ENABLE_CLEANUP_CLOSED,
+                        loop=self.event_loop,
+                    ),
+                )
+                self._client_sessions[key] = client_session
+            self._client_session_references[client_session] += 1
+            self._client_session = client_session
         return self._client_session
 
     @property
@@ -163,47 +306,91 @@ class CloudStack(object):
         :return: Dictionary containing the decoded json reply of the CloudStack API
         :rtype: dict
         """
-        kwargs.update(dict(apikey=self.api_key, command=command, response="json"))
+        kwargs.pop(
+            "signature", None
+        )  # remove potential existing signature from url parameters
+        kwargs["apikey"] = self.api_key
+        kwargs["command"] = command
+        kwargs["response"] = "json"
+        paginated, await_final_result = self._command_properties(command)
 
-        if (
-            "list" in command.lower()
-        ):  # list APIs can be paginated, therefore include max_page_size and
+        if paginated:
+            # list APIs can be paginated, therefore include max_page_size and
             # page parameter
-            kwargs.update(dict(pagesize=self.max_page_size, page=1))
+            kwargs["pagesize"] = self.max_page_size
+            kwargs["page"] = 1
+            page_template = self._page_template(kwargs)
+            query = page_template.format(1)
+        else:
+            page_template = None
+            query = self._encode(sorted(kwargs.items()))
 
-        final_data = dict()
-        while True:
-            async with self.client_session.get(
-                self.end_point, params=self._sign(kwargs)
-            ) as response:
-                data = await self._handle_response(
-                    response=response,
-                    await_final_result="queryasyncjobresult" not in command.lower(),
+        data = await self._fetch(query, await_final_result=await_final_result)
+        try:
+            count = data.pop("count")
+        except KeyError:
+            # Only list API calls have a 'count' key inside the response, return
+            # data as it is in other cases! Empty dictionary is returned in case
+            # a query does not contain any results.
+            return data
+
+        # list APIs return the total number of items in the 'count' key, so all
+        # remaining pages can be requested concurrently once the first page has
+        # been received.
+        pages = math.ceil(count / self.max_page_size) if page_template else 1
+        remaining_pages = await asyncio.gather(
+            *(
+                self._fetch(
+                    page_template.format(page), await_final_result=await_final_result
                 )
-                try:
-                    count = data.pop("count")
-                except KeyError:
-                    if not data:
-                        # Empty dictionary is returned in case a query does not
-                        # contain any results.Can happen also if a listAPI is
-                        # called with a page that does not exist. Therefore,
-                        # final_data has to be returned in order to return all
-                        # results from preceding pages.
-                        return final_data
-                    else:
-                        # Only list API calls have a 'count' key inside the response,
-                        # return data as it is in other cases!
-                        return data
-                else:
-                    # update final_data using paginated results, dictionaries of
-                    # the response contain the count key and one key pointing to
-                    # the actual data values
-                    for key, value in data.items():
-                        final_data.setdefault(key, []).extend(value)
-                    final_data["count"] = final_data.setdefault("count", 0) + count
-                    kwargs["page"] += 1
-                    if count < self.max_page_size:  # no more pages exists
-                        return final_data
+                for page in range(2, pages + 1)
+            )
+        )
+
+        # update final_data using paginated results, dictionaries of the response
+        # contain the count key and one key pointing to the actual data values.
+        # An empty dictionary is returned for a page that does not exist (anymore).
+        final_data = dict(count=count)
+        for page_data in (data, *remaining_pages):
+            page_data.pop("count", None)
+            for key, value in page_data.items():
+                final_data.setdefault(key, []).extend(value)
+        return final_data
+
+    async def queryAsyncJobResult(self, **kwargs) -> dict:
+        """
+        Async co-routine to query the result of an asynchronous CloudStack API call.
+        It is defined explicitly, since it is polled repeatedly while waiting
+        for asynchronous API calls to finish.
+
+        :param kwargs: Parameters to be passed to the CloudStack API, usually
+            the jobid
+        :return: Dictionary containing the decoded json reply of the CloudStack API
+        :rtype: dict
+        """
+        return await self.request(command="queryAsyncJobResult", **kwargs)
+
+    async def _fetch(self, query: str, await_final_result: bool) -> dict:
+        """
+        Signs the query string and performs a single request to the CloudStack API.
+        The query string is passed on as it is, since it has already been url
+        encoded to calculate the signature.
+
+        :param query: The url encoded query string of the API call including the
+            command string
+        :type query: str
+        :param await_final_result: Specifier that indicates whether the function
+            should poll the asyncJobResult API until the asynchronous API call
+            has been processed
+        :type await_final_result: bool
+        :return: Dictionary containing the JSON response of the API call
+        :rtype: dict
+        """
+        url = URL("{}?{}".format(self.end_point, self._sign(query)), encoded=True)
+        async with self.client_session.get(url) as response:
+            return await self._handle_response(
+                response=response, await_final_result=await_final_result
+            )
 
     async def _handle_response(
         self, response: aiohttp.client_reqrep.ClientResponse, await_final_result: bool
@@ -224,9 +411,7 @@ class CloudStack(object):
         :return: Dictionary containing the JSON response of the API call
         :rtype: dict
         """
-        try:
-            data = await response.json()
-        except aiohttp.client_exceptions.ContentTypeError as ex:
+        if not JSON_CONTENT_TYPE.match(response.content_type):
             text = await response.text()
             logging.debug(
                 'Content returned by server not of type "application/json"\n Content: {}'.format(  # noqa E501
@@ -235,8 +420,22 @@ class CloudStack(object):
             )
             raise CloudStackClientException(
                 message="Could not decode content. Server did not return json content!"
-            ) from ex
+            )
         else:
+            # decode the raw body, so that orjson (if available) can parse the
+            # bytes directly without decoding them to str first
+            body = await response.read()
+            try:
+                data = json_loads(body)
+            except ValueError as ex:  # base class of all JSONDecodeErrors
+                logging.debug(
+                    "Content returned by server is not valid json\n Content: {}".format(
+                        body
+                    )
+                )
+                raise CloudStackClientException(
+                    message="Could not decode content. Server did not return json content!"  # noqa E501
+                ) from ex
             data = self._transform_data(data)
             if response.status != 200:
                 raise CloudStackClientException(
@@ -246,9 +445,42 @@ class CloudStack(object):
                     response=data,
                 ) from None
 
-        while await_final_result and ("jobid" in data):
-            await asyncio.sleep(self.async_poll_latency)
-            data = await self.queryAsyncJobResult(jobid=data["jobid"])
+        if await_final_result and ("jobid" in data):
+            return await self._poll_job(data["jobid"])
+
+        return data
+
+    async def wait_for_jobs(self, jobids: list) -> list:
+        """
+        Async co-routine to wait for several asynchronous CloudStack API calls at
+        once, for example after deploying multiple virtual machines with the
+        result of the API calls not being awaited. The jobs are polled concurrently.
+
+        :param jobids: Job ids of the asynchronous API calls
+        :type jobids: list
+        :return: List containing the results of the asynchronous API calls in the
+            order of the given job ids
+        :rtype: list
+        """
+        return await asyncio.gather(*(self._poll_job(jobid) for jobid in jobids))
+
+    async def _poll_job(self, jobid: str) -> dict:
+        """
+        Polls the queryAsyncJobResult API until the asynchronous API call with the
+        given job id has been processed. The time between two polls starts at
+        async_poll_latency and is doubled after each poll, but never exceeds
+        max_async_poll_latency.
+
+        :param jobid: Job id of the asynchronous API call
+        :type jobid: str
+        :return: Dictionary containing the result of the asynchronous API call
+        :rtype: dict
+        """
+        poll_latency = min(self.async_poll_latency, self.max_async_poll_latency)
+        while True:
+            await asyncio.sleep(poll_latency)
+            poll_latency = min(2 * poll_latency, self.max_async_poll_latency)
+            data = await self.queryAsyncJobResult(jobid=jobid)
             if data["jobstatus"]:  # jobstatus is 0 for pending async CloudStack calls
                 if not data["jobresultcode"]:  # exit code is zero
                     try:
@@ -263,9 +495,7 @@ class CloudStack(object):
                     response=data,
                 ) from None
 
-        return data
-
-    def _sign(self, url_parameters: dict) -> dict:
+    def _sign(self, query: str) -> str:
         """
         According to the CloudStack documentation, each request needs to be
         signed in order to authenticate the user account executing the API command.
@@ -274,28 +504,112 @@ class CloudStack(object):
         to generate a unique identifier, the url parameters have to be transformed
         to lower case and ordered alphabetically.
 
+        :param query: The url encoded query string of the API call including the
+            command string, ordered alphabetically by the parameter names. It must
+            not contain a signature, :py:meth:`request` removes a signature passed
+            by the caller, so that requests are always signed freshly.
+        :type query: str
+        :return: The query string including a new parameter, which contains the
+            signature
+        :rtype: str
+        """
+        return "{}&signature={}".format(query, self._cached_signature(query))
+
+    def _page_template(self, url_parameters: dict) -> str:
+        """
+        The requests of a paginated API call only differ in the page parameter.
+        Therefore, all other url parameters are sorted and encoded only once into
+        a request string containing a placeholder for the page number.
+
         :param url_parameters: The url parameters of the API call including the
             command string
         :type url_parameters: dict
-        :return: The url parameters including a new key, which contains the signature
-        :rtype: dict
+        :return: Request string with a placeholder for the page number
+        :rtype: str
         """
-        if url_parameters:
-            url_parameters.pop(
-                "signature", None
-            )  # remove potential existing signature from url parameters
-            request_string = urlencode(
-                sorted(url_parameters.items()), safe=".-*_", quote_via=quote
-            ).lower()
-            digest = hmac.new(
-                self.api_secret.encode("utf-8"),
-                request_string.encode("utf-8"),
-                hashlib.sha1,
-            ).digest()
-            url_parameters["signature"] = (
-                base64.b64encode(digest).decode("utf-8").strip()
-            )
-        return url_parameters
+        items = sorted(
+            (key, value) for key, value in url_parameters.items() if key != "page"
+        )
+        parts = (
+            self._encode([item for item in items if item[0] < "page"]),
+            "page={}",  # encoded values cannot contain curly brackets
+            self._encode([item for item in items if item[0] > "page"]),
+        )
+        return "&".join(part for part in parts if part)
+
+    @staticmethod
+    def _signature(inner_hash, outer_hash, request_string: str) -> str:
+        """
+        Calculates the signature of an url encoded request string, which has
+        to be ordered alphabetically by the parameter names.
+
+        :param inner_hash: SHA-1 hash of the inner padded HMAC key derived from
+            the api secret, it is copied and not modified
+        :param outer_hash: SHA-1 hash of the outer padded HMAC key derived from
+            the api secret, it is copied and not modified
+        :param request_string: The url encoded request string
+        :type request_string: str
+        :return: The url encoded base64 HMAC-SHA1 signature of the request string
+        :rtype: str
+        """
+        inner = inner_hash.copy()
+        # url encoded strings are pure ASCII, so bytes.lower() is sufficient
+        inner.update(request_string.encode("ascii").lower())
+        outer = outer_hash.copy()
+        outer.update(inner.digest())
+        return quote(base64.b64encode(outer.digest()).decode("ascii"), safe="")
+
+    @classmethod
+    def _encode(cls, items: list) -> str:
+        """
+        Url encodes a sequence of url parameters as required to sign a request.
+
+        :param items: Sequence of url parameter name and value pairs
+        :type items: list
+        :return: The url encoded request string
+        :rtype: str
+        """
+        quote_parameter = cls._quote  # look up once instead of for each parameter
+        return "&".join(
+            [
+                quote_parameter(key) + "=" + quote_parameter(value)
+                for key, value in items
+            ]
+        )
+
+    @staticmethod
+    def _quote(value) -> str:
+        """
+        Url encodes a single url parameter name or value. Most of them (ids, names,
+        numbers) do not contain any character that needs to be escaped, so they
+        are returned unchanged without going through :py:func:`urllib.parse.quote`.
+
+        :param value: Url parameter name or value
+        :return: The url encoded string
+        :rtype: str
+        """
+        value = str(value)
+        if URL_SAFE_STRING.fullmatch(value):
+            return value
+        return quote(value, safe=".-*_")
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _command_properties(command: str) -> Tuple[bool, bool]:
+        """
+        Determines how the API call specified by the command string has to be
+        processed. Since the properties only depend on the command string, they
+        are computed once per command and cached afterwards.
+
+        :param command: Command string indicating the CloudStack API to be called.
+        :type command: str
+        :return: Whether the API call is paginated (list APIs) and whether the
+            final result of asynchronous API calls has to be awaited (all APIs
+            except queryAsyncJobResult)
+        :rtype: Tuple[bool, bool]
+        """
+        lower_command = command.lower()
+        return "list" in lower_command, "queryasyncjobresult" not in lower_command
 
     @staticmethod
     def _transform_data(data: dict) -> dict:
@@ -310,8 +624,7 @@ class CloudStack(object):
             originated the response.
         :rtype: dict
         """
-        for key in data.keys():
-            return_value = data[key]
-            if isinstance(return_value, dict):
-                return return_value
+        for value in data.values():
+            if isinstance(value, dict):
+                return value
         return data
@@ -1,10 +1,12 @@
 from setuptools import setup, find_packages
-import os
+from pathlib import Path
 
-repo_base_dir = os.path.abspath(os.path.dirname(__file__))
+repo_base_dir = Path(__file__).resolve().parent
 
-with open(os.path.join(repo_base_dir, "README.md"), "r") as read_me:
-    long_description = read_me.read()
+try:
+    long_description = (repo_base_dir / "README.md").read_text(encoding="utf-8")
+except FileNotFoundError:
+    long_description = ""
 
 setup(
     name="CloudStackAIO",
@@ -33,9 +35,14 @@ setup(
     ],
     keywords="asyncio cloudstack client",
     packages=find_packages(exclude=["tests"]),
-    install_requires=["aiohttp"],
+    install_requires=["aiohttp", "orjson; implementation_name=='cpython'", "yarl"],
     extras_require={
-        "contrib": ["flake8", "flake8-bugbear", "black; implementation_name=='cpython'"]
+        "contrib": [
+            "flake8",
+            "flake8-bugbear",
+            "black; implementation_name=='cpython'",
+        ],
+        "uvloop": ["uvloop; sys_platform!='win32' and implementation_name=='cpython'"],
     },
     test_suite="tests",
     zip_safe=False,
@@ -3,16 +3,39 @@ from CloudStackAIO.CloudStack import CloudStackClientException
 
 from aiohttp import web
 from unittest import TestCase
+from unittest.mock import patch
+from urllib.parse import parse_qsl
 
 import asyncio
+import base64
+import hashlib
+import hmac
+import warnings
 
 
 class TestCloudStack(TestCase):
-    event_loop = asyncio.get_event_loop()
+    event_loop = None
     runner = None
+    port = None
+    pages_in_flight = []
+    pending_job_polls = []
+    # signed parameters shared by all tests, tests must not modify them
+    test_params = {
+        "command": "echo",
+        "Test_Image": "Vm_Image_Centos",
+        "Test_Disk": "20",
+        "Test_Memory": "100",
+        "apikey": "Test",
+        "response": "json",
+        "pagesize": "500",
+        "page": "1",
+        "signature": "bw/an0XOIvGmxoGX4qh5GOPj9G8=",
+    }
 
     @classmethod
     def setUpClass(cls):
+        cls.event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(cls.event_loop)
         routes = web.RouteTableDef()
 
         def async_handler(url_parameters):
@@ -47,6 +70,13 @@ class TestCloudStack(TestCase):
                     )
                 ),
             }
+            if int(url_parameters.get("jobid")) == 4:
+                cls.pending_job_polls.append(4)
+                if len(cls.pending_job_polls) < 3:
+                    return web.json_response(
+                        dict(query_async_job_result=dict(jobid=4, jobstatus=0))
+                    )
+                return response[1]
             return response[int(url_parameters.get("jobid"))]
 
         def list_handler(url_parameters):
@@ -54,7 +84,7 @@ class TestCloudStack(TestCase):
                 1: web.json_response(
                     dict(
                         list_test_response=dict(
-                            count=500,
+                            count=900,
                             response=[
                                 dict(test1=1, test2=2),
                             ],
@@ -64,7 +94,7 @@ class TestCloudStack(TestCase):
                 2: web.json_response(
                     dict(
                         list_test_response=dict(
-                            count=400,
+                            count=900,
                             response=[
                                 dict(test3=3, test4=4),
                             ],
@@ -79,7 +109,7 @@ class TestCloudStack(TestCase):
                 1: web.json_response(
                     dict(
                         list_test_response=dict(
-                            count=500,
+                            count=1500,
                             response=[
                                 dict(test1=1, test2=2),
                             ],
@@ -89,7 +119,7 @@ class TestCloudStack(TestCase):
                 2: web.json_response(
                     dict(
                         list_test_response=dict(
-                            count=500,
+                            count=1500,
                             response=[
                                 dict(test3=3, test4=4),
                             ],
@@ -100,6 +130,20 @@ class TestCloudStack(TestCase):
             }
             return response[int(url_parameters.get("page"))]
 
+        async def list_handler_concurrent(url_parameters):
+            page = int(url_parameters.get("page"))
+            cls.pages_in_flight.append(page)
+            in_flight = list(cls.pages_in_flight)
+            await asyncio.sleep(0.05)
+            cls.pages_in_flight.remove(page)
+            return web.json_response(
+                dict(
+                    list_test_response=dict(
+                        count=1200, response=[dict(page=page, in_flight=in_flight)]
+                    )
+                )
+            )
+
         @routes.get("/compute")
         async def compute(request):
             response = {
@@ -109,11 +153,15 @@ class TestCloudStack(TestCase):
                     ),
                     status=523,
                 ),
-                "echo": lambda x: web.json_response(dict(echoresponse=dict(x.items()))),
+                "echo": lambda x: web.json_response(dict(echoresponse=dict(x))),
                 "hello": lambda x: web.json_response(
                     dict(helloresponse=dict(text="Hello, world"))
                 ),
                 "nojson": lambda x: web.Response(text="This is not a json response!"),
+                "invalidjson": lambda x: web.Response(
+                    text="{This is not a json response!",
+                    content_type="application/json",
+                ),
                 "async_ok": lambda x: web.json_response(
                     dict(async_ok_response=dict(jobid=1))
                 ),
@@ -123,9 +171,13 @@ class TestCloudStack(TestCase):
                 "async_missing_results": lambda x: web.json_response(
                     dict(async_ok_response=dict(jobid=3))
                 ),
+                "async_pending": lambda x: web.json_response(
+                    dict(async_ok_response=dict(jobid=4))
+                ),
                 "queryAsyncJobResult": async_handler,
                 "list_tests": list_handler,
                 "list_tests_empty_paginated": list_handler_empty_paginated,
+                "list_tests_concurrent": list_handler_concurrent,
                 "list_tests_empty": lambda x: web.json_response(
                     dict(list_test_response=dict())
                 ),
@@ -133,7 +185,11 @@ class TestCloudStack(TestCase):
                     dict(message="timed out after 1000.0 milliseconds"), status=500
                 ),
             }
-            return response[request.rel_url.query.get("command")](request.rel_url.query)
+            query = request.query
+            response = response[query.get("command")](query)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
 
         app = web.Application()
         app.add_routes(routes)
@@ -143,12 +199,17 @@ class TestCloudStack(TestCase):
     @classmethod
     def tearDownClass(cls):
         cls.event_loop.run_until_complete(cls.stop_server())
+        asyncio.set_event_loop(None)
+        cls.event_loop.close()
 
     @classmethod
     async def start_server(cls):
         await cls.runner.setup()
-        site = web.TCPSite(cls.runner, "localhost", 8080)
+        # bind to an ephemeral port, so that the test server never clashes with
+        # other services or concurrently running test processes
+        site = web.TCPSite(cls.runner, "127.0.0.1", 0)
         await site.start()
+        cls.port = cls.runner.addresses[0][1]
 
     @classmethod
     async def stop_server(cls):
@@ -156,103 +217,225 @@ class TestCloudStack(TestCase):
 
     def setUp(self):
         self.cloud_stack_client = CloudStack(
-            end_point="http://localhost:8080/compute",
+            end_point="http://127.0.0.1:{}/compute".format(self.port),
             api_key="Test",
             api_secret="Test",
             event_loop=self.event_loop,
             async_poll_latency=0,
         )
-        self.test_params = {
-            "command": "echo",
-            "Test_Image": "Vm_Image_Centos",
-            "Test_Disk": "20",
-            "Test_Memory": "100",
-            "apikey": "Test",
-            "response": "json",
-            "pagesize": "500",
-            "page": "1",
-            "signature": "bw/an0XOIvGmxoGX4qh5GOPj9G8=",
-        }
+
+    def tearDown(self):
+        self.event_loop.run_until_complete(self.cloud_stack_client.close())
 
     def test_hello_world_request(self):
-        response = asyncio.ensure_future(
-            self.cloud_stack_client.request(command="hello"), loop=self.event_loop
-        )
         self.assertEqual(
-            self.event_loop.run_until_complete(response), {"text": "Hello, world"}
+            self.event_loop.run_until_complete(
+                self.cloud_stack_client.request(command="hello")
+            ),
+            {"text": "Hello, world"},
         )
 
     def test_url_with_params(self):
-        response = asyncio.ensure_future(
-            self.cloud_stack_client.request(**self.test_params), loop=self.event_loop
+        self.assertEqual(
+            self.event_loop.run_until_complete(
+                self.cloud_stack_client.request(**self.test_params)
+            ),
+            self.test_params,
         )
-        self.assertEqual(self.event_loop.run_until_complete(response), self.test_params)
 
     def test_hello_world_getattr(self):
-        response = asyncio.ensure_future(
-            self.cloud_stack_client.hello(), loop=self.event_loop
+        self.assertEqual(
+            self.event_loop.run_until_complete(self.cloud_stack_client.hello()),
+            {"text": "Hello, world"},
         )
+
+    def test_getattr_caching(self):
+        api_call = self.cloud_stack_client.hello
+        self.assertIs(self.cloud_stack_client.hello, api_call)
+        self.assertIs(self.cloud_stack_client._api_calls["hello"], api_call)
+        with self.assertRaises(AttributeError):
+            self.cloud_stack_client.__dict__
+        with self.assertRaises(TypeError):
+            vars(self.cloud_stack_client)
+        self.assertEqual(list(self.cloud_stack_client._api_calls), ["hello"])
         self.assertEqual(
-            self.event_loop.run_until_complete(response), {"text": "Hello, world"}
+            self.event_loop.run_until_complete(api_call()), {"text": "Hello, world"}
         )
 
     def test_url_with_params_getattr(self):
-        response = asyncio.ensure_future(
-            self.cloud_stack_client.echo(**self.test_params), loop=self.event_loop
+        self.assertEqual(
+            self.event_loop.run_until_complete(
+                self.cloud_stack_client.echo(**self.test_params)
+            ),
+            self.test_params,
+        )
+
+    def test_url_with_escaped_params(self):
+        name = "Test Vm/01+ä=&*"
+        response = self.event_loop.run_until_complete(
+            self.cloud_stack_client.echo(name=name)
+        )
+        self.assertEqual(response["name"], name)
+        self.assertEqual(response, self.sign(response))
+
+    def sign(self, url_parameters):
+        url_parameters = dict(url_parameters)
+        url_parameters.pop("signature", None)
+        query = self.cloud_stack_client._sign(
+            CloudStack._encode(sorted(url_parameters.items()))
         )
-        self.assertEqual(self.event_loop.run_until_complete(response), self.test_params)
+        return dict(parse_qsl(query))
 
     def test_signature_of_params(self):
         test_signature = self.test_params["signature"]
 
-        test_params = self.cloud_stack_client._sign(self.test_params)
+        test_params = self.sign(self.test_params)
+        self.assertEqual(test_params, self.test_params)
         self.assertEqual(test_params["signature"], test_signature)
 
-    def test_no_json_response_getattr(self):
-        response = asyncio.ensure_future(
-            self.cloud_stack_client.nojson(), loop=self.event_loop
+    def test_signature_of_params_after_secret_change(self):
+        test_signature = self.test_params["signature"]
+
+        self.cloud_stack_client.api_secret = "Changed"
+        test_params = self.sign(self.test_params)
+        self.assertNotEqual(test_params["signature"], test_signature)
+
+        self.cloud_stack_client.api_secret = "Test"
+        test_params = self.sign(self.test_params)
+        self.assertEqual(test_params["signature"], test_signature)
+
+    def test_signature_cache(self):
+        for _ in range(3):
+            self.event_loop.run_until_complete(
+                self.cloud_stack_client.request(command="hello")
+            )
+        cache_info = self.cloud_stack_client._cached_signature.cache_info()
+        self.assertEqual((cache_info.hits, cache_info.misses), (2, 1))
+
+    def test_signature_of_paginated_params(self):
+        test_params = dict(self.test_params)
+        test_params.pop("signature")
+        page_template = self.cloud_stack_client._page_template(test_params)
+
+        for page in range(1, 4):
+            self.assertEqual(
+                page_template.format(page),
+                CloudStack._encode(sorted(dict(test_params, page=page).items())),
+            )
+
+    def test_signature_of_params_with_long_secret(self):
+        api_secret = "Test" * 20  # longer than the SHA-1 block size
+        self.cloud_stack_client.api_secret = api_secret
+        test_params = self.sign(self.test_params)
+
+        request_string = "&".join(
+            "{}={}".format(key, value)
+            for key, value in sorted(test_params.items())
+            if key != "signature"
+        ).lower()
+        digest = hmac.new(
+            api_secret.encode("utf-8"), request_string.encode("utf-8"), hashlib.sha1
+        ).digest()
+        self.assertEqual(
+            test_params["signature"], base64.b64encode(digest).decode("utf-8")
         )
+
+    def test_no_json_response_getattr(self):
         with self.assertRaises(CloudStackClientException) as context:
-            self.event_loop.run_until_complete(response)
+            self.event_loop.run_until_complete(self.cloud_stack_client.nojson())
         self.assertEqual(
             context.exception.message,
             "Could not decode content. Server did not return json content!",
         )
 
     def test_no_json_response(self):
-        response = asyncio.ensure_future(
-            self.cloud_stack_client.request(command="nojson"), loop=self.event_loop
+        with self.assertRaises(CloudStackClientException) as context:
+            self.event_loop.run_until_complete(
+                self.cloud_stack_client.request(command="nojson")
+            )
+        self.assertEqual(
+            context.exception.message,
+            "Could not decode content. Server did not return json content!",
         )
+
+    def test_invalid_json_response(self):
         with self.assertRaises(CloudStackClientException) as context:
-            self.event_loop.run_until_complete(response)
+            self.event_loop.run_until_complete(self.cloud_stack_client.invalidjson())
         self.assertEqual(
             context.exception.message,
             "Could not decode content. Server did not return json content!",
         )
 
     def test_async_response_okay(self):
-        response = asyncio.ensure_future(
-            self.cloud_stack_client.request(command="async_ok"), loop=self.event_loop
-        )
         self.assertEqual(
-            self.event_loop.run_until_complete(response), {"text": "Hello, world"}
+            self.event_loop.run_until_complete(
+                self.cloud_stack_client.request(command="async_ok")
+            ),
+            {"text": "Hello, world"},
         )
 
     def test_async_response_okay_getattr(self):
-        response = asyncio.ensure_future(
-            self.cloud_stack_client.async_ok(), loop=self.event_loop
+        self.assertEqual(
+            self.event_loop.run_until_complete(self.cloud_stack_client.async_ok()),
+            {"text": "Hello, world"},
         )
+
+    def test_async_response_pending(self):
+        self.pending_job_polls.clear()
         self.assertEqual(
-            self.event_loop.run_until_complete(response), {"text": "Hello, world"}
+            self.event_loop.run_until_complete(self.cloud_stack_client.async_pending()),
+            {"text": "Hello, world"},
         )
+        self.assertEqual(len(self.pending_job_polls), 3)
 
-    def test_async_response_failed_return_code(self):
-        response = asyncio.ensure_future(
-            self.cloud_stack_client.request(command="async_failed_return_code"),
-            loop=self.event_loop,
+    def test_async_poll_backoff(self):
+        real_sleep = asyncio.sleep
+
+        async def run_pending_job(async_poll_latency, max_async_poll_latency):
+            self.pending_job_polls.clear()
+            self.cloud_stack_client.async_poll_latency = async_poll_latency
+            self.cloud_stack_client.max_async_poll_latency = max_async_poll_latency
+            poll_latencies = []
+
+            async def sleep(delay):
+                poll_latencies.append(delay)
+                await real_sleep(0)
+
+            with patch("asyncio.sleep", sleep):
+                self.assertEqual(
+                    await self.cloud_stack_client.async_pending(),
+                    {"text": "Hello, world"},
+                )
+            return poll_latencies
+
+        self.assertEqual(
+            self.event_loop.run_until_complete(run_pending_job(1, 30)), [1, 2, 4]
+        )
+        self.assertEqual(
+            self.event_loop.run_until_complete(run_pending_job(2, 3)), [2, 3, 3]
+        )
+        self.assertEqual(
+            self.event_loop.run_until_complete(run_pending_job(60, 30)), [30, 30, 30]
+        )
+
+    def test_wait_for_jobs(self):
+        self.assertEqual(
+            self.event_loop.run_until_complete(
+                self.cloud_stack_client.wait_for_jobs(jobids=[1, 1])
+            ),
+            [{"text": "Hello, world"}, {"text": "Hello, world"}],
         )
         with self.assertRaises(CloudStackClientException) as context:
-            self.event_loop.run_until_complete(response)
+            self.event_loop.run_until_complete(
+                self.cloud_stack_client.wait_for_jobs(jobids=[1, 2])
+            )
+        self.assertEqual(context.exception.error_code, 255)
+
+    def test_async_response_failed_return_code(self):
+        with self.assertRaises(CloudStackClientException) as context:
+            self.event_loop.run_until_complete(
+                self.cloud_stack_client.request(command="async_failed_return_code")
+            )
         exception = context.exception
         self.assertEqual(exception.message, "Async CloudStack call failed!")
         self.assertEqual(exception.error_code, 255)
@@ -266,12 +449,10 @@ class TestCloudStack(TestCase):
         self.assertEqual(repr(exception), str(exception))
 
     def test_async_response_missing_results(self):
-        response = asyncio.ensure_future(
-            self.cloud_stack_client.request(command="async_missing_results"),
-            loop=self.event_loop,
-        )
         with self.assertRaises(CloudStackClientException) as context:
-            self.event_loop.run_until_complete(response)
+            self.event_loop.run_until_complete(
+                self.cloud_stack_client.request(command="async_missing_results")
+            )
         exception = context.exception
         self.assertEqual(exception.message, "Async CloudStack call failed!")
         self.assertEqual(exception.error_code, 254)
@@ -285,19 +466,103 @@ class TestCloudStack(TestCase):
         self.assertEqual(repr(exception), str(exception))
 
     def test_closing_session_with_running_loop(self):
-        async def async_sleep():
-            await asyncio.ensure_future(
-                self.cloud_stack_client.hello(), loop=self.event_loop
-            )
-            del self.cloud_stack_client
-            await asyncio.sleep(0.1)
+        async def async_close():
+            await self.cloud_stack_client.hello()
+            client_session = self.cloud_stack_client.client_session
+            await self.cloud_stack_client.close()
+            self.assertTrue(client_session.closed)
+
+        self.event_loop.run_until_complete(async_close())
+
+    def test_async_context_manager(self):
+        async def async_with():
+            async with self.cloud_stack_client as cloud_stack_client:
+                self.assertEqual(
+                    await cloud_stack_client.hello(), {"text": "Hello, world"}
+                )
+                return cloud_stack_client.client_session
+
+        client_session = self.event_loop.run_until_complete(async_with())
+        self.assertTrue(client_session.closed)
+
+    def test_shared_client_session(self):
+        cloud_stack_client = CloudStack(
+            end_point="http://127.0.0.1:{}/compute".format(self.port),
+            api_key="Test",
+            api_secret="Test",
+            event_loop=self.event_loop,
+        )
+        client_session = cloud_stack_client.client_session
+        self.assertIs(self.cloud_stack_client.client_session, client_session)
+
+        self.event_loop.run_until_complete(cloud_stack_client.close())
+        self.assertFalse(client_session.closed)
+        self.event_loop.run_until_complete(self.cloud_stack_client.close())
+        self.assertTrue(client_session.closed)
+
+    def test_client_session_per_api_key(self):
+        cloud_stack_client = CloudStack(
+            end_point="http://127.0.0.1:{}/compute".format(self.port),
+            api_key="Other",
+            api_secret="Other",
+            event_loop=self.event_loop,
+        )
+        self.assertIsNot(
+            cloud_stack_client.client_session, self.cloud_stack_client.client_session
+        )
+        self.event_loop.run_until_complete(cloud_stack_client.close())
 
-        self.event_loop.run_until_complete(async_sleep())
+    def test_replaced_client_session(self):
+        client_session = self.cloud_stack_client.client_session
+        self.event_loop.run_until_complete(client_session.close())
+
+        cloud_stack_client = CloudStack(
+            end_point="http://127.0.0.1:{}/compute".format(self.port),
+            api_key="Test",
+            api_secret="Test",
+            event_loop=self.event_loop,
+        )
+        self.assertIsNot(cloud_stack_client.client_session, client_session)
+        self.assertNotIn(client_session, CloudStack._client_session_references)
+        self.event_loop.run_until_complete(cloud_stack_client.close())
+
+        self.event_loop.run_until_complete(self.cloud_stack_client.close())
+        self.assertNotIn(client_session, CloudStack._client_session_references)
+        self.assertFalse(CloudStack._client_sessions)
+
+    def test_client_session_creation_warnings(self):
+        with warnings.catch_warnings(record=True) as caught_warnings:
+            warnings.simplefilter("always")
+            self.cloud_stack_client.client_session
+        self.assertFalse(
+            [
+                warning
+                for warning in caught_warnings
+                if "enable_cleanup_closed" in str(warning.message)
+            ]
+        )
+
+    def test_unclosed_client_warning(self):
+        client_session = self.cloud_stack_client.client_session
+        cloud_stack_client = CloudStack(
+            end_point="http://127.0.0.1:{}/compute".format(self.port),
+            api_key="Test",
+            api_secret="Test",
+            event_loop=self.event_loop,
+        )
+        self.assertIs(cloud_stack_client.client_session, client_session)
+
+        with self.assertWarns(ResourceWarning):
+            del cloud_stack_client
+        # the deleted client has released its reference, so closing the surviving
+        # client closes the shared session
+        self.event_loop.run_until_complete(self.cloud_stack_client.close())
+        self.assertTrue(client_session.closed)
+        self.assertNotIn(client_session, CloudStack._client_session_references)
 
     def test_paginated_list_api_call(self):
-        response = asyncio.ensure_future(self.cloud_stack_client.list_tests())
         self.assertEqual(
-            self.event_loop.run_until_complete(response),
+            self.event_loop.run_until_complete(self.cloud_stack_client.list_tests()),
             {
                 "count": 900,
                 "response": [dict(test1=1, test2=2), dict(test3=3, test4=4)],
@@ -305,17 +570,36 @@ class TestCloudStack(TestCase):
         )
 
     def test_empty_list_api_call(self):
-        response = asyncio.ensure_future(self.cloud_stack_client.list_tests_empty())
-        self.assertEqual(self.event_loop.run_until_complete(response), {})
+        self.assertEqual(
+            self.event_loop.run_until_complete(
+                self.cloud_stack_client.list_tests_empty()
+            ),
+            {},
+        )
 
-    def test_empty_paginated_list_api_call(self):
-        response = asyncio.ensure_future(
-            self.cloud_stack_client.list_tests_empty_paginated()
+    def test_concurrent_paginated_list_api_call(self):
+        response = self.event_loop.run_until_complete(
+            self.cloud_stack_client.list_tests_concurrent()
+        )
+        self.assertEqual(response["count"], 1200)
+        self.assertEqual([page["page"] for page in response["response"]], [1, 2, 3])
+        self.assertEqual(response["response"][0]["in_flight"], [1])
+        # pages 2 and 3 are requested concurrently after page 1 has been received
+        self.assertEqual(
+            max(
+                (sorted(page["in_flight"]) for page in response["response"][1:]),
+                key=len,
+            ),
+            [2, 3],
         )
+
+    def test_empty_paginated_list_api_call(self):
         self.assertEqual(
-            self.event_loop.run_until_complete(response),
+            self.event_loop.run_until_complete(
+                self.cloud_stack_client.list_tests_empty_paginated()
+            ),
             {
-                "count": 1000,
+                "count": 1500,
                 "response": [dict(test1=1, test2=2), dict(test3=3, test4=4)],
             },
         )
@@ -347,15 +631,16 @@ class TestCloudStack(TestCase):
 
     def test_loop_optionality(self):
         cloud_stack_client = CloudStack(
-            end_point="http://localhost:8080/compute",
+            end_point="http://127.0.0.1:{}/compute".format(self.port),
             api_key="Test",
             api_secret="Test",
             async_poll_latency=0,
         )
 
-        response = asyncio.ensure_future(
-            cloud_stack_client.request(command="hello"), loop=self.event_loop
-        )
         self.assertEqual(
-            self.event_loop.run_until_complete(response), {"text": "Hello, world"}
+            self.event_loop.run_until_complete(
+                cloud_stack_client.request(command="hello")
+            ),
+            {"text": "Hello, world"},
         )
+        self.event_loop.run_until_complete(cloud_stack_client.close())